@@ -1,30 +1,217 @@
 # app.py
-from flask import Flask, jsonify, abort, send_file
+from flask import Flask, jsonify, abort, request, send_file
+from flask.json.provider import JSONProvider
+from decimal import Decimal
+import functools
+import math
 import os
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import URL
+import re
+import orjson
+from psycopg.rows import dict_row
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import URL, make_url
 from sqlalchemy.exc import OperationalError
 
-_engine = None
+# Statements are built once at import so SQLAlchemy's compiled cache always
+# hits and the driver can reuse server-side prepared statements
 
-def get_engine():
-    global _engine
-    if _engine is not None:
-        return _engine
+# Version + row counts in a single round-trip. Counts are planner estimates
+# (pg_class.reltuples, refreshed by VACUUM/ANALYZE), so this stays O(1)
+# regardless of table size; -1 means the table was never analyzed
+_Q_DB_STATS = text("""
+    SELECT
+        version() AS version,
+        MAX(c.reltuples) FILTER (WHERE c.relname = 'coordinates')::bigint AS coordinates_count,
+        MAX(c.reltuples) FILTER (WHERE c.relname = 'metadata')::bigint AS metadata_count,
+        MAX(c.reltuples) FILTER (WHERE c.relname = 'annotations_terms')::bigint AS annotations_terms_count
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'ns'
+      AND c.relname IN ('coordinates', 'metadata', 'annotations_terms')
+""")
+
+_Q_SAMPLE_COORDINATES = text(
+    "SELECT study_id, ST_X(geom) AS x, ST_Y(geom) AS y, ST_Z(geom) AS z FROM ns.coordinates LIMIT 3"
+)
+_Q_SAMPLE_METADATA = text("SELECT * FROM ns.metadata LIMIT 3")
+_Q_SAMPLE_ANNOTATIONS = text(
+    "SELECT study_id, contrast_id, term, weight FROM ns.annotations_terms LIMIT 3"
+)
+
+# A study matches a term if its title mentions it OR it carries the tf-idf
+# annotation; A - B is computed server-side with EXCEPT
+_Q_DISSOC_TERMS = text("""
+    WITH diff AS (
+        SELECT study_id FROM ns.metadata WHERE title ILIKE :pattern_a
+        UNION
+        SELECT study_id FROM ns.annotations_terms WHERE term = :tfidf_a
+        EXCEPT
+        (
+            SELECT study_id FROM ns.metadata WHERE title ILIKE :pattern_b
+            UNION
+            SELECT study_id FROM ns.annotations_terms WHERE term = :tfidf_b
+        )
+    )
+    SELECT m.study_id, m.title, w.weight, COUNT(*) OVER () AS total
+    FROM diff
+    JOIN ns.metadata m USING (study_id)
+    LEFT JOIN (
+        SELECT study_id, MAX(weight) AS weight
+        FROM ns.annotations_terms
+        WHERE term = :tfidf_a
+        GROUP BY study_id
+    ) w USING (study_id)
+    ORDER BY w.weight DESC NULLS LAST, m.study_id
+    LIMIT 100
+""")
+
+# Studies near A minus studies near B, computed server-side. Binds are cast
+# explicitly so generic prepared plans still see a geometry constant and keep
+# the GiST index scan on ST_DWithin
+_Q_DISSOC_LOC = text("""
+    SELECT study_id, COUNT(*) OVER () AS total
+    FROM (
+        SELECT study_id
+        FROM ns.coordinates
+        WHERE ST_DWithin(
+            geom,
+            ST_SetSRID(ST_MakePoint(CAST(:x1 AS float8), CAST(:y1 AS float8), CAST(:z1 AS float8)), 4326)::geometry,
+            10
+        )
+        EXCEPT
+        SELECT study_id
+        FROM ns.coordinates
+        WHERE ST_DWithin(
+            geom,
+            ST_SetSRID(ST_MakePoint(CAST(:x2 AS float8), CAST(:y2 AS float8), CAST(:z2 AS float8)), 4326)::geometry,
+            10
+        )
+    ) diff
+    ORDER BY study_id
+    LIMIT 100
+""")
+
+def _build_engine():
+    """
+    Create the engine once at import time (None if DB_URL is unset, so
+    DB-free routes still work); get_engine() reports the missing variable.
+    No connection is opened here. The indexes the queries rely on are built
+    by create_db.py, not at import.
+    """
     db_url = os.getenv("DB_URL")
     if not db_url:
-        raise RuntimeError("Missing DB_URL (or DATABASE_URL) environment variable.")
-    # Normalize old 'postgres://' scheme to 'postgresql://'
-    if db_url.startswith("postgres://"):
-        db_url = "postgresql://" + db_url[len("postgres://"):]
-    _engine = create_engine(
+        return None
+    # Normalize old 'postgres://' scheme and pick the psycopg 3 driver
+    for scheme in ("postgres://", "postgresql://"):
+        if db_url.startswith(scheme):
+            db_url = "postgresql+psycopg://" + db_url[len(scheme):]
+    connect_args = {}
+    if make_url(db_url).get_driver_name() == "psycopg":
+        # psycopg 3 prepares a statement once it has run this many times on a
+        # connection, so each query is prepared on its second run; later runs
+        # skip parsing, and re-planning stops once Postgres picks a generic plan
+        connect_args["prepare_threshold"] = 1
+    # Each gunicorn worker is one process with its own pool, shared by all of
+    # its greenlets (they queue for a free connection). Split the app's total
+    # connection budget across workers so workers x pool_size stays below the
+    # server's max_connections. Connections are recycled periodically instead
+    # of pinged on every checkout.
+    # WEB_CONCURRENCY is set by gunicorn.conf.py's on_starting hook; without
+    # gunicorn there is a single process
+    budget = max(1, int(os.getenv("DB_MAX_CONNECTIONS", "40")))
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    engine = create_engine(
         db_url,
-        pool_pre_ping=True,
+        pool_size=max(1, budget // workers),
+        max_overflow=0,
+        pool_recycle=1800,
+        pool_use_lifo=True,
+        pool_pre_ping=False,
+        connect_args=connect_args,
     )
-    return _engine
+
+    # Set the schema once per physical connection rather than per request.
+    # Run it outside a transaction so a later rollback cannot undo it.
+    @event.listens_for(engine, "connect")
+    def _set_search_path(dbapi_conn, _):
+        autocommit = dbapi_conn.autocommit
+        dbapi_conn.autocommit = True
+        cur = dbapi_conn.cursor()
+        cur.execute("SET SESSION search_path TO ns, public")
+        cur.close()
+        dbapi_conn.autocommit = autocommit
+
+    return engine
+
+_ENGINE = _build_engine()
+
+def get_engine():
+    if _ENGINE is None:
+        raise RuntimeError("Missing DB_URL (or DATABASE_URL) environment variable.")
+    return _ENGINE
+
+# Terms are words separated by spaces, '_' or '-' (e.g. posterior_cingulate);
+# anything else is rejected before touching the database (this also keeps
+# client-supplied % wildcards out of the ILIKE pattern)
+_TERM_RE = re.compile(r"[a-z0-9 _\-]+")
+# Annotation names are space-separated (terms_abstract_tfidf__posterior cingulate)
+_TERM_TR = str.maketrans({"_": " ", "-": " "})
+
+def _term_params(term):
+    """Return (title ILIKE pattern, tf-idf term name), or None if term is invalid."""
+    term = term.lower()
+    if not _TERM_RE.fullmatch(term):
+        return None
+    return f"%{term.replace('_', ' ')}%", f"terms_abstract_tfidf__{term.translate(_TERM_TR)}"
+
+# Dissociation results depend only on their inputs and rarely-changing
+# tables, so repeat queries are served from a per-process LRU cache.
+# Callers pass ?nocache=1 to bypass it; restart the workers to invalidate it.
+@functools.lru_cache(maxsize=2048)
+def _dissociate_terms(pattern_a, tfidf_a, pattern_b, tfidf_b):
+    """Return (total_count, ((study_id, title, weight), ...)) for A - B."""
+    with get_engine().begin() as conn:
+        rows = conn.execute(_Q_DISSOC_TERMS, {
+            "pattern_a": pattern_a, "tfidf_a": tfidf_a,
+            "pattern_b": pattern_b, "tfidf_b": tfidf_b,
+        }).fetchall()
+    total_count = rows[0][3] if rows else 0
+    return total_count, tuple((study_id, title, weight) for study_id, title, weight, _ in rows)
+
+def _round_mm(point):
+    """Round each coordinate to the nearest 1 mm; halves round up (2.5 -> 3, -2.5 -> -2)."""
+    return tuple(float(math.floor(v + 0.5)) for v in point)
+
+@functools.lru_cache(maxsize=2048)
+def _dissociate_locations(point_a, point_b):
+    """Return (total_count, (study_id, ...)) for studies near point_a but not point_b."""
+    (x1, y1, z1), (x2, y2, z2) = point_a, point_b
+    with get_engine().begin() as conn:
+        rows = conn.execute(_Q_DISSOC_LOC, {
+            "x1": x1, "y1": y1, "z1": z1,
+            "x2": x2, "y2": y2, "z2": z2,
+        }).fetchall()
+    total_count = rows[0][1] if rows else 0
+    return total_count, tuple(row[0] for row in rows)
+
+def _json_default(obj):
+    # Types orjson does not serialize natively (e.g. NUMERIC columns)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson; used transparently by jsonify()."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 def create_app():
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)
 
     @app.get("/", endpoint="health")
     def health():
@@ -32,7 +219,15 @@ def create_app():
 
     @app.get("/img", endpoint="show_img")
     def show_img():
-        return send_file("amygdala.gif", mimetype="image/gif")
+        # Static asset: let browsers cache it and revalidate with ETag /
+        # Last-Modified (derived from the file) for cheap 304 responses
+        return send_file(
+            "amygdala.gif",
+            mimetype="image/gif",
+            conditional=True,
+            etag=True,
+            max_age=86400,
+        )
 
     @app.get("/terms/<term>/studies", endpoint="terms_studies")
     def get_studies_by_term(term):
@@ -50,37 +245,30 @@ def create_app():
 
         try:
             with eng.begin() as conn:
-                # Ensure we are in the correct schema
-                conn.execute(text("SET search_path TO ns, public;"))
-                payload["version"] = conn.exec_driver_sql("SELECT version()").scalar()
-
-                # Counts
-                payload["coordinates_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.coordinates")).scalar()
-                payload["metadata_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.metadata")).scalar()
-                payload["annotations_terms_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.annotations_terms")).scalar()
-
-                # Samples
-                try:
-                    rows = conn.execute(text(
-                        "SELECT study_id, ST_X(geom) AS x, ST_Y(geom) AS y, ST_Z(geom) AS z FROM ns.coordinates LIMIT 3"
-                    )).mappings().all()
-                    payload["coordinates_sample"] = [dict(r) for r in rows]
-                except Exception:
-                    payload["coordinates_sample"] = []
-
+                # Pipeline mode: send every statement before reading any
+                # result, so the whole health check costs about one round-trip.
+                # A failing statement raises when the pipeline exits and aborts
+                # the ones after it, so the check is all-or-nothing (500).
+                dbapi_conn = conn.connection.dbapi_connection
+                queries = {
+                    "stats": _Q_DB_STATS,
+                    "coordinates_sample": _Q_SAMPLE_COORDINATES,
+                    "metadata_sample": _Q_SAMPLE_METADATA,
+                    "annotations_terms_sample": _Q_SAMPLE_ANNOTATIONS,
+                }
+                cursors = {key: dbapi_conn.cursor(row_factory=dict_row) for key in queries}
                 try:
-                    rows = conn.execute(text("SELECT * FROM ns.metadata LIMIT 3")).mappings().all()
-                    payload["metadata_sample"] = [dict(r) for r in rows]
-                except Exception:
-                    payload["metadata_sample"] = []
+                    with dbapi_conn.pipeline():
+                        for key, query in queries.items():
+                            cursors[key].execute(query.text)
 
-                try:
-                    rows = conn.execute(text(
-                        "SELECT study_id, contrast_id, term, weight FROM ns.annotations_terms LIMIT 3"
-                    )).mappings().all()
-                    payload["annotations_terms_sample"] = [dict(r) for r in rows]
-                except Exception:
-                    payload["annotations_terms_sample"] = []
+                    payload.update(cursors["stats"].fetchone())
+                    for key, cur in cursors.items():
+                        if key != "stats":
+                            payload[key] = cur.fetchall()
+                finally:
+                    for cur in cursors.values():
+                        cur.close()
 
             payload["ok"] = True
             return jsonify(payload), 200
@@ -96,78 +284,34 @@ def create_app():
         but NOT term_b (in title OR abstract)
         With full details: study_id, title, weight
         """
-        eng = get_engine()
+        params_a = _term_params(term_a)
+        params_b = _term_params(term_b)
+        if params_a is None or params_b is None:
+            return jsonify({"error": "Terms may only contain letters, digits, spaces, '_' and '-'"}), 400
         
         try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                
-                # Query logic: search both title and abstract
-                query_template = text("""
-                    SELECT DISTINCT m.study_id, m.title
-                    FROM ns.metadata m
-                    LEFT JOIN ns.annotations_terms at ON m.study_id = at.study_id
-                    WHERE 
-                        m.title ILIKE :term_pattern
-                        OR 
-                        at.term = :term_tfidf
-                """)
-                
-                # Prepare parameters
-                term_a_pattern = f"%{term_a.replace('_', ' ')}%"
-                term_a_tfidf = f"terms_abstract_tfidf__{term_a.lower().replace('-', '_')}"
-                
-                term_b_pattern = f"%{term_b.replace('_', ' ')}%"
-                term_b_tfidf = f"terms_abstract_tfidf__{term_b.lower().replace('-', '_')}"
-                
-                # Query studies with term_a
-                result_a = conn.execute(
-                    query_template, 
-                    {"term_pattern": term_a_pattern, "term_tfidf": term_a_tfidf}
-                ).fetchall()
-                studies_a = {row[0]: row[1] for row in result_a}
-                
-                # Query studies with term_b
-                result_b = conn.execute(
-                    query_template,
-                    {"term_pattern": term_b_pattern, "term_tfidf": term_b_tfidf}
-                ).fetchall()
-                studies_b = set(row[0] for row in result_b)
-                
-                # Set operation: A - B
-                difference_ids = set(studies_a.keys()) - studies_b
-                
-                # Get detailed information including weight
-                detailed_results = []
-                for study_id in difference_ids:
-                    # Get weight for term_a in this study
-                    weight_query = text("""
-                        SELECT weight 
-                        FROM ns.annotations_terms 
-                        WHERE study_id = :sid AND term = :term
-                        LIMIT 1
-                    """)
-                    weight_result = conn.execute(
-                        weight_query, 
-                        {"sid": study_id, "term": term_a_tfidf}
-                    ).fetchone()
-                    
-                    detailed_results.append({
-                        "study_id": study_id,
-                        "title": studies_a[study_id] or "No title available",
-                        "weight": float(weight_result[0]) if weight_result else 0.0
-                    })
-                
-                # Sort by weight descending
-                detailed_results.sort(key=lambda x: x['weight'], reverse=True)
-                
-                return jsonify({
-                    "term_a": term_a,
-                    "term_b": term_b,
-                    "total_count": len(detailed_results),
-                    "results": detailed_results
-                })
-                
+            query = _dissociate_terms
+            if request.args.get("nocache") == "1":
+                query = _dissociate_terms.__wrapped__
+            total_count, rows = query(*params_a, *params_b)
+            
+            # Rows arrive sorted by weight for term_a, descending
+            detailed_results = [
+                {
+                    "study_id": study_id,
+                    "title": title or "No title available",
+                    "weight": float(weight) if weight is not None else 0.0
+                }
+                for study_id, title, weight in rows
+            ]
+            
+            return jsonify({
+                "term_a": term_a,
+                "term_b": term_b,
+                "total_count": total_count,
+                "results": detailed_results
+            })
+            
         except Exception as e:
             return jsonify({"error": str(e)}), 500
         
@@ -181,45 +325,35 @@ def create_app():
         Returns studies near coords_a but NOT near coords_b
         Uses 10mm radius for proximity
         """
-        eng = get_engine()
+        # Malformed input is rejected before any connection is checked out.
+        try:
+            point_a = tuple(float(v) for v in coords_a.split("_"))
+            point_b = tuple(float(v) for v in coords_b.split("_"))
+            if len(point_a) != 3 or len(point_b) != 3:
+                raise ValueError("expected x_y_z")
+            if not all(math.isfinite(v) for v in point_a + point_b):
+                raise ValueError("non-finite coordinate")
+        except ValueError:
+            return jsonify({"error": "Coordinates must be given as x_y_z numbers"}), 400
         
         try:
-            # Parse coordinates
-            x1, y1, z1 = map(float, coords_a.split("_"))
-            x2, y2, z2 = map(float, coords_b.split("_"))
+            if request.args.get("nocache") == "1":
+                # Bypass the cache and query the exact points given
+                query = _dissociate_locations.__wrapped__
+            else:
+                # Round to the nearest 1 mm so nearby queries share a cache entry
+                query = _dissociate_locations
+                point_a, point_b = _round_mm(point_a), _round_mm(point_b)
+            total_count, study_ids = query(point_a, point_b)
+            
+            return jsonify({
+                "location_a": list(point_a),
+                "location_b": list(point_b),
+                "studies_near_a_not_b": list(study_ids),
+                "count": total_count,
+                "radius_mm": 10
+            })
             
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                
-                # Find studies near location A
-                query_a = text("""
-                    SELECT DISTINCT study_id 
-                    FROM ns.coordinates 
-                    WHERE ST_DWithin(
-                        geom, 
-                        ST_SetSRID(ST_MakePoint(:x, :y, :z), 4326),
-                        10
-                    )
-                """)
-                
-                result_a = conn.execute(query_a, {"x": x1, "y": y1, "z": z1}).fetchall()
-                studies_a = set(row[0] for row in result_a)
-                
-                # Find studies near location B
-                result_b = conn.execute(query_a, {"x": x2, "y": y2, "z": z2}).fetchall()
-                studies_b = set(row[0] for row in result_b)
-                
-                # Calculate difference (A without B)
-                difference = studies_a - studies_b
-                
-                return jsonify({
-                    "location_a": [x1, y1, z1],
-                    "location_b": [x2, y2, z2],
-                    "studies_near_a_not_b": list(difference)[:100],
-                    "count": len(difference),
-                    "radius_mm": 10
-                })
-                
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
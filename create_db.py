@@ -57,7 +57,7 @@ def ensure_schema(engine: Engine, schema: str):
 def ensure_extensions(engine: Engine):
     with engine.begin() as conn:
         conn.execute(text("CREATE EXTENSION IF NOT EXISTS postgis;"))
-        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm;"))
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;"))
         conn.execute(text("CREATE EXTENSION IF NOT EXISTS unaccent;"))
 
 
@@ -170,7 +170,13 @@ def build_metadata(engine: Engine, df: pd.DataFrame, schema: str, if_exists: str
                 );
             """))
             conn.execute(text(f"ANALYZE {schema}.metadata;"))
-    print("→ metadata (FTS + trigger) done.")
+
+    # Trigram index so the API's unanchored `title ILIKE '%term%'` is an index scan
+    print("→ metadata: creating trigram GIN index on title")
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_metadata_title_trgm ON {schema}.metadata USING GIN (title gin_trgm_ops);"))
+        conn.execute(text(f"ANALYZE {schema}.metadata;"))
+    print("→ metadata (FTS + trigger + trigram) done.")
 
 
 # -----------------------------
@@ -325,7 +331,7 @@ def main():
 
     print("\n=== Ready ===")
     print(f"- coordinates  : {args.schema}.coordinates (geometry(POINTZ,{args.srid}) + GIST)")
-    print(f"- metadata     : {args.schema}.metadata (FTS + trigger + GIN)")
+    print(f"- metadata     : {args.schema}.metadata (FTS + trigger + GIN + title trigram)")
     print(f"- annotations  : {args.schema}.annotations_terms (sparse via COPY)" + (" + annotations_json (GIN)" if args.enable_json else ""))
 
 
@@ -0,0 +1,22 @@
+# gunicorn.conf.py
+# Picked up automatically by `gunicorn app:app` when run from the repo root.
+import os
+
+# The endpoints mostly wait on Postgres, so use gevent workers: each worker
+# keeps many requests in flight instead of blocking on one slow query
+worker_class = "gevent"
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "500"))
+
+def on_starting(server):
+    # Export the worker count gunicorn actually resolved (this file, -w or
+    # WEB_CONCURRENCY) so app.py can split DB_MAX_CONNECTIONS across workers
+    os.environ["WEB_CONCURRENCY"] = str(server.cfg.workers)
+
+# psycopg 3 picks its socket-wait function once, when it is first imported:
+# the C `wait_c` (blocks the whole event loop) unless gevent has already
+# patched `select`, in which case it uses a pure-Python wait that yields to
+# other greenlets. The gevent worker monkey-patches right after fork, so the
+# app (which imports psycopg) must be loaded in the worker, never preloaded
+# into the master: keep preload_app off and do not pass --preload.
+preload_app = False